@@ -10,6 +10,9 @@ import cv2
 import json
 import glob
 import copy
+import queue
+import struct
+import threading
 import numpy as np
 #import seaborn as sns
 
@@ -17,29 +20,56 @@ from osgeo import gdal
 from mpi4py import MPI
 #from matplotlib import pyplot as plt
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pyhdf.SD import SD, SDC
 
+try:
+    import h5py
+except ImportError:
+    h5py = None
 
-def _int64_feature(value):
-    return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
+try:
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
-def _bytes_feature(value):
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+MOD02_1KM_FIELDS = {
+    "EV_250_Aggr1km_RefSB": [0, 1],
+    "EV_500_Aggr1km_RefSB": [0, 1],
+    "EV_1KM_RefSB": [x for x in range(15) if x not in (12, 14)],
+    # 6,7 are very noisy water vapor channels
+    "EV_1KM_Emissive": [0, 1, 2, 3, 10, 11],
+}
 
+# Progress is printed every `LOG_EVERY` patches, printing and flushing every patch
+# is slow when stdout is forwarded by MPI
+LOG_EVERY = 1000
 
-def _float_feature(value):
-    return tf.train.Feature(float_list=tf.train.FloatList(value=value))
+# MPI tags of the filename requests and replies between workers and rank 0
+REQUEST_TAG = 1
+REPLY_TAG = 2
 
+# Swaths bigger than this are normalized with statistics of every
+# `STATS_SUBSAMPLE_STEP`th row and column
+STATS_SUBSAMPLE_NBYTES = 1 << 30
+STATS_SUBSAMPLE_STEP = 4
 
-def gen_swaths(fnames, mode, resize):
+
+def gen_swaths(fnames, mode, resize, verbose=False):
     """Reads and yields resized swaths.
     Args:
         fnames: Iterable of filenames to read
-        mode: {"mod09_tif", "mod02_1km"} determines wheter to processes the file as a tif
-            or a hdf file
+        mode: {"mod09_tif", "mod02_1km", "mod02_1km_h5"} determines wheter to processes
+            the file as a tif, a hdf file or a hdf5 file made by `convert_hdf_to_h5`
         resize: Float or None - factor to resize the image by e.g. 0.5 to halve height and
             width. If resize is none then no resizing is performed.
+        verbose: Print every filename as it is read.
     Yields:
         filename, (resized) swath
     """
@@ -47,63 +77,203 @@ def gen_swaths(fnames, mode, resize):
     # Define helper function to catch the exception from gdal directly
     def gdOpen(file):
         # print('Filename being opened by gdal:',file, flush=True)
-        try:
-            output = gdal.Open(file).ReadAsArray()
-        except IOError:
-            print("Error while opening file:", file, flush=True)
-        return output
+        dataset = gdal.Open(file)
+        if dataset is None:
+            raise IOError("gdal could not open " + file)
+        return dataset.ReadAsArray()
 
     if mode == "mod09_tif":
         # read = lambda tif_file: gdal.Open(tif_file).ReadAsArray()
         read = lambda tif_file: gdOpen(tif_file)
 
     elif mode == "mod02_1km":
-        names_1km = {
-            "EV_250_Aggr1km_RefSB": [0, 1],
-            "EV_500_Aggr1km_RefSB": [0, 1],
-            "EV_1KM_RefSB": [x for x in range(15) if x not in (12, 14)],
-            # 6,7 are very noisy water vapor channels
-            "EV_1KM_Emissive": [0, 1, 2, 3, 10, 11],
-        }
-        read = lambda hdf_file: read_hdf(hdf_file, names_1km)
+        read = lambda hdf_file: read_hdf(hdf_file, MOD02_1KM_FIELDS)
+
+    elif mode == "mod02_1km_h5":
+        _require_h5py(mode)
+        read = read_h5
 
     else:
         raise ValueError("Invalid reader mode", mode)
 
     rank = MPI.COMM_WORLD.Get_rank()
     for t in fnames:
-        print("rank", rank, "reading", t, flush=True)
+        if verbose:
+            print("rank", rank, "reading", t, flush=True)
 
         try:
-            swath = np.rollaxis(read(t), 0, 3)
+            swath = read(t).transpose(1, 2, 0)
         except Exception as e:
             print(rank, "Could not read", t, "because", e)
             continue
 
         if resize is not None:
-            swath = cv2.resize(
-                swath, dsize=None, fx=resize, fy=resize, interpolation=cv2.INTER_AREA
-            )
+            k = int(round(1 / resize)) if resize <= 1 else 0
+            if k >= 1 and abs(resize - 1 / k) < 1e-6:
+                swath = box_downsample(swath, k)
+            else:
+                swath = cv2.resize(
+                    swath,
+                    dsize=None,
+                    fx=resize,
+                    fy=resize,
+                    interpolation=cv2.INTER_AREA,
+                )
         yield t, swath
 
 
+def box_downsample(swath, k):
+    """Averages every `k` x `k` block of a (height, width, channel) swath. This is what
+    cv2.INTER_AREA does when resizing by 1/k, without OpenCV's per channel loop.
+    Trailing rows and columns that do not fill a block are dropped and the dtype of
+    `swath` is kept.
+    """
+    h, w, c = swath.shape
+    h, w = h // k, w // k
+    blocks = swath[: h * k, : w * k].reshape(h, k, w, k, c)
+    out = blocks.mean(axis=(1, 3), dtype=np.float32)
+    if swath.dtype.kind in "iu":
+        out = np.rint(out, out=out)
+    return out.astype(swath.dtype)
+
+
 def read_hdf(hdf_file, fields, x_range=(None, None), y_range=(None, None)):
-    """Read `hdf_file` and extract relevant fields as per `names_1km`.
+    """Read `hdf_file` and extract relevant fields as per `MOD02_1KM_FIELDS`.
     """
     x_min, x_max = x_range
     y_min, y_max = y_range
     hdf = SD(hdf_file, SDC.READ)
 
-    swath = [hdf.select(f)[:, x_min:x_max, y_min:y_max][fields[f]] for f in fields]
-    return np.concatenate(swath, axis=0)
+    # Read only the selected bands, straight into one preallocated array
+    n_bands = sum(len(bands) for bands in fields.values())
+    swath = None
+    i = 0
+    for f in fields:
+        sds = hdf.select(f)
+        for b in fields[f]:
+            band = sds[b, x_min:x_max, y_min:y_max]
+            if swath is None:
+                swath = np.empty((n_bands,) + band.shape, dtype=band.dtype)
+            swath[i] = band
+            i += 1
+    return swath
+
+
+def _require_h5py(mode):
+    if h5py is None:
+        raise ImportError("h5py is required for mode " + mode)
+
+
+def convert_hdf_to_h5(hdf_file, out_dir, fields=MOD02_1KM_FIELDS):
+    """Stage the `fields` of `hdf_file` into `out_dir`/<basename>.h5 as one contiguous
+    (bands, height, width) dataset "swath" that `read_h5` can read with MPI-IO.
+    Returns:
+        path of the written hdf5 file
+    """
+    _require_h5py("mod02_1km_to_h5")
+    h5_file = os.path.join(
+        out_dir, os.path.splitext(os.path.basename(hdf_file))[0] + ".h5"
+    )
+    with h5py.File(h5_file, "w") as f:
+        f.create_dataset("swath", data=read_hdf(hdf_file, fields))
+    return h5_file
 
 
-def gen_patches(swaths, shape, strides):
+def read_h5(h5_file, x_range=(None, None), y_range=(None, None)):
+    """Read the swath staged by `convert_hdf_to_h5`. Uses the MPI-IO driver when h5py
+    is built with MPI support. Each rank owns its files so they are opened on
+    COMM_SELF with independent I/O; opening on COMM_WORLD would be collective.
+    """
+    _require_h5py("mod02_1km_h5")
+    x_min, x_max = x_range
+    y_min, y_max = y_range
+    if h5py.get_config().mpi:
+        f = h5py.File(h5_file, "r", driver="mpio", comm=MPI.COMM_SELF)
+    else:
+        f = h5py.File(h5_file, "r")
+    with f:
+        return f["swath"][:, x_min:x_max, y_min:y_max]
+
+
+def max_value_count(values):
+    """Returns how many times the most frequent value occurs in `values`.
+    8 and 16 bit integer data (e.g. MODIS reflectance) is counted with a histogram in
+    one pass instead of sorting it with `np.unique`.
+    """
+    values = values.ravel()
+    if values.dtype.kind in "iu" and values.dtype.itemsize <= 2:
+        values = values.astype(np.intp)
+        return np.bincount(values - values.min()).max()
+    return np.unique(values, return_counts=True)[1].max()
+
+
+def swath_stats(swath):
+    """Returns the per channel mean and std of `swath` as float32. Swaths over
+    `STATS_SUBSAMPLE_NBYTES` are estimated from a strided view of every
+    `STATS_SUBSAMPLE_STEP`th row and column, which is plenty for whitening and reads
+    a fraction of the swath.
+    """
+    if swath.nbytes > STATS_SUBSAMPLE_NBYTES:
+        swath = swath[::STATS_SUBSAMPLE_STEP, ::STATS_SUBSAMPLE_STEP]
+    mean = swath.mean(axis=(0, 1), dtype=np.float64)
+    std = swath.std(axis=(0, 1), dtype=np.float64)
+    return mean.astype(np.float32), std.astype(np.float32)
+
+
+def whiten_cloudy_patch(patch, inv_std, bias, threshold, offset, counts, out):
+    """Fused cloud filter and normalization for 16 bit integer patches. Compiled with
+    numba when it is installed.
+    Args:
+        patch: (height, width, channel) integer patch
+        inv_std, bias: per channel whitening, out = patch * inv_std + bias
+        threshold: a channel is cloudy if its most frequent value occurs fewer times
+        offset: smallest value of the patch dtype, counts are indexed by value - offset
+        counts: zeroed int32 histogram with 2**16 bins, left zeroed on return
+        out: float32 array of the patch shape, written only if the patch is kept
+    Returns:
+        True if some channel is cloudy and `out` holds the normalized patch.
+    """
+    h, w, c = patch.shape
+    has_clouds = False
+    for k in range(c):
+        max_count = 0
+        for i in range(h):
+            for j in range(w):
+                v = patch[i, j, k] - offset
+                counts[v] += 1
+                if counts[v] > max_count:
+                    max_count = counts[v]
+        # Only reset the bins this channel touched
+        for i in range(h):
+            for j in range(w):
+                counts[patch[i, j, k] - offset] = 0
+        if max_count < threshold:
+            has_clouds = True
+            break
+
+    if not has_clouds:
+        return False
+
+    for i in range(h):
+        for j in range(w):
+            for k in range(c):
+                out[i, j, k] = patch[i, j, k] * inv_std[k] + bias[k]
+    return True
+
+
+if njit is not None:
+    whiten_cloudy_patch = njit(cache=True, fastmath=True, boundscheck=False)(
+        whiten_cloudy_patch
+    )
+
+
+def gen_patches(swaths, shape, strides, rng=None):
     """Normalizes swaths and yields patches of size `shape` every `strides` pixels
     Args:
         swaths: Iterable of (filename, np.ndarray) to slice patches from
         shape: (height, width) patch size
         strides: (x_steps, y_steps) how many pixels between patches
+        rng: np.random.Generator to shuffle patches with, a fresh unseeded one if None
     Yields:
         (filename, coordinate, patch): where the coordinate is the pixel coordinate of the
         patch inside of filename. BUG: pixel coorindate is miscalculated if swath is
@@ -111,45 +281,217 @@ def gen_patches(swaths, shape, strides):
     """
     stride_x, stride_y = strides
     shape_x, shape_y = shape
+    if rng is None:
+        rng = np.random.default_rng()
 
     for fname, swath in swaths:
+        # Swaths smaller than a patch (e.g. small tiles or after resizing) have none
+        if swath.shape[0] < shape_x or swath.shape[1] < shape_y:
+            continue
+
         # NOTE: Normalizing the whole (sometimes 8gb) swath will double memory usage
         # by casting it from int16 to float32. Instead normalize and cast patches.
         # TODO other kinds of normalization e.g. max scaling.
-        mean = swath.mean(axis=(0, 1)).astype(np.float32)
-        std = swath.std(axis=(0, 1)).astype(np.float32)
-        max_x, max_y, _ = swath.shape
+        mean, std = swath_stats(swath)
+        # Whiten with one multiply-add: (patch - mean) / std == patch * inv_std + bias
+        with np.errstate(divide="ignore"):
+            inv_std = np.float32(1.0) / std
+        bias = -mean * inv_std
+        # Integer swaths with finite statistics cannot produce NaN patches.
+        check_nan = swath.dtype.kind not in "iu" or not np.isfinite(bias).all()
+        use_kernel = (
+            njit is not None
+            and not check_nan
+            and swath.dtype in (np.int16, np.uint16)
+        )
+        if use_kernel:
+            counts = np.zeros(1 << 16, dtype=np.int32)
+            offset = np.iinfo(swath.dtype).min
+            out = np.empty((shape_x, shape_y, swath.shape[2]), dtype=np.float32)
+
+        # Zero-copy view of every patch, shape (nx, ny, channels, shape_x, shape_y)
+        windows = np.lib.stride_tricks.sliding_window_view(
+            swath, shape, axis=(0, 1)
+        )[::stride_x, ::stride_y]
+        nx, ny = windows.shape[:2]
 
         # Shuffle patches
-        coords = []
-        for x in range(0, max_x, stride_x):
-            for y in range(0, max_y, stride_y):
-                if x + shape_x < max_x and y + shape_y < max_y:
-                    coords.append((x, y))
-        np.random.shuffle(coords)
-
-        for x, y in coords:
-            patch = swath[x : x + shape_x, y : y + shape_y]
-            # Filter away patches with Nans or if every channel is over 50% 1 value
-            # Ie low cloud fraction.
-            threshold = shape_x * shape_y * 0.5
-            max_uniq = lambda c: max(np.unique(patch[:, :, c], return_counts=True)[1])
-            has_clouds = any(max_uniq(c) < threshold for c in range(patch.shape[-1]))
+        idx = np.arange(nx * ny, dtype=np.int32)
+        rng.shuffle(idx)
+
+        # Filter away patches with Nans or if every channel is over 50% 1 value
+        # Ie low cloud fraction.
+        threshold = shape_x * shape_y * 0.5
+        for i in idx:
+            xi, yi = divmod(int(i), ny)
+            x, y = xi * stride_x, yi * stride_y
+            patch = windows[xi, yi].transpose(1, 2, 0)
+            if use_kernel:
+                if whiten_cloudy_patch(
+                    patch, inv_std, bias, threshold, offset, counts, out
+                ):
+                    yield fname, (x, y), out
+                    # A yielded patch may still be waiting to be serialized while
+                    # the next one is produced, so it keeps its buffer. Rejected
+                    # patches leave `out` untouched and it is reused.
+                    out = np.empty_like(out)
+                continue
+
+            has_clouds = any(
+                max_value_count(patch[:, :, c]) < threshold
+                for c in range(patch.shape[-1])
+            )
             if has_clouds:
-                patch = (patch.astype(np.float32) - mean) / std
-                if not np.isnan(patch).any():
+                # order="C" since swaths are transposed views of (bands, H, W) data
+                # and the default order="K" would keep that planar layout
+                patch = patch.astype(np.float32, order="C")
+                np.multiply(patch, inv_std, out=patch)
+                np.add(patch, bias, out=patch)
+                if not (check_nan and np.isnan(patch).any()):
                     yield fname, (x, y), patch
 
 
+# Name of the on-disk dtype of each --precision
+PRECISION_DTYPES = {"fp32": "float32", "bf16": "bfloat16", "int8": "int8"}
+
+
+def quantize_patch(patch, precision):
+    """Converts a normalized float32 patch to the on-disk `precision`.
+    Args:
+        patch: (height, width, channel) float32 patch
+        precision: {"fp32", "bf16", "int8"}
+    Returns:
+        (data, scale): For "fp32" data is the patch itself. For "bf16" data holds the
+        bfloat16 bits, the float32 rounded to nearest even upper 16 bits, as uint16.
+        For "int8" data is int8 with patch ~= data * scale and one float32 scale per
+        channel. scale is None unless precision is "int8".
+    """
+    if precision == "fp32":
+        return patch, None
+
+    if precision == "bf16":
+        bits = np.ascontiguousarray(patch, dtype=np.float32).view(np.uint32)
+        bits = bits + np.uint32(0x7FFF) + ((bits >> 16) & 1)
+        return (bits >> 16).astype(np.uint16), None
+
+    if precision == "int8":
+        scale = np.abs(patch).max(axis=(0, 1)).astype(np.float32) / 127
+        scale[scale == 0] = 1
+        data = np.clip(np.rint(patch / scale), -127, 127).astype(np.int8)
+        return data, scale
+
+    raise ValueError("Invalid precision", precision)
+
+
+# Serializing tf.train.Example by hand. The protobuf wire format of a length delimited
+# field is its tag byte, the payload length as a varint and the payload. Messages are
+# kept as lists of byte chunks so the patch bytes are only copied by the final join.
+# tf.train.Example   {Features features = 1}
+# tf.train.Features  {map<string, Feature> feature = 1}, entries are {key = 1, value = 2}
+# tf.train.Feature   {BytesList bytes_list = 1, FloatList float_list = 2,
+#                     Int64List int64_list = 3}, each list is {repeated value = 1}
+_FIELD_1 = b"\x0a"
+_FIELD_2 = b"\x12"
+_FIELD_3 = b"\x1a"
+_BYTES_LIST, _FLOAT_LIST, _INT64_LIST = _FIELD_1, _FIELD_2, _FIELD_3
+
+
+def _varint(value):
+    value &= 0xFFFFFFFFFFFFFFFF  # negative int64 are encoded as 10 byte two's complement
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _delimited(tag, chunks):
+    return [tag, _varint(sum(len(c) for c in chunks))] + chunks
+
+
+# Map entry keys of the features written by `serialize_example`
+_KEYS = {
+    k: b"".join(_delimited(_FIELD_1, [k.encode("utf-8")]))
+    for k in ("filename", "coordinate", "shape", "patch", "dtype", "scale")
+}
+
+
+def _feature_entry(key, kind, value):
+    feature = _delimited(kind, _delimited(_FIELD_1, value))
+    return _delimited(_FIELD_1, [_KEYS[key]] + _delimited(_FIELD_2, feature))
+
+
+def serialize_example(filename, coord, patch, precision="fp32"):
+    """Returns the serialized tf.train.Example of a patch, encoded directly instead of
+    building the protobuf message feature by feature. Parses back to the features
+    "filename", "coordinate", "shape", "patch", "dtype" and, for int8, "scale".
+    """
+    data, scale = quantize_patch(patch, precision)
+    # Bytes in C order without an intermediate copy, joined into the result once
+    data = memoryview(np.ascontiguousarray(data)).cast("B")
+    int64s = lambda values: [b"".join(_varint(int(v)) for v in values)]
+    entries = (
+        _feature_entry("filename", _BYTES_LIST, [filename.encode("utf-8")])
+        + _feature_entry("coordinate", _INT64_LIST, int64s(coord))
+        + _feature_entry("shape", _INT64_LIST, int64s(patch.shape))
+        + _feature_entry("patch", _BYTES_LIST, [data])
+        + _feature_entry(
+            "dtype", _BYTES_LIST, [PRECISION_DTYPES[precision].encode("utf-8")]
+        )
+    )
+    if scale is not None:
+        floats = np.asarray(scale, dtype="<f4").tobytes()
+        entries += _feature_entry("scale", _FLOAT_LIST, [floats])
+    return b"".join(_delimited(_FIELD_1, entries))
+
+
 def write_feature(writer, filename, coord, patch):
-    feature = {
-        "filename": _bytes_feature(bytes(filename, encoding="utf-8")),
-        "coordinate": _int64_feature(coord),
-        "shape": _int64_feature(patch.shape),
-        "patch": _bytes_feature(patch.ravel().tobytes()),
-    }
-    example = tf.train.Example(features=tf.train.Features(feature=feature))
-    writer.write(example.SerializeToString())
+    writer.write(serialize_example(filename, coord, patch))
+
+
+def _masked_crc32c(data):
+    crc = google_crc32c.value(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+class RecordWriter(object):
+    """Drop-in replacement for `TFRecordWriter` that frames records itself and writes
+    them through a large buffer, so many small writes become few large ones.
+    Requires `google_crc32c` for the record checksums.
+    """
+
+    def __init__(self, path, buffer_size=16 << 20):
+        self._f = open(path, "wb", buffering=buffer_size)
+
+    def write(self, record):
+        length = struct.pack("<Q", len(record))
+        self._f.write(length)
+        self._f.write(struct.pack("<I", _masked_crc32c(length)))
+        self._f.write(record)
+        self._f.write(struct.pack("<I", _masked_crc32c(record)))
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_record_writer(path, buffer_size=16 << 20):
+    """Opens a buffered `RecordWriter` at `path`, falling back to tensorflow's
+    `TFRecordWriter` if `google_crc32c` is not installed.
+    """
+    if google_crc32c is None:
+        return tf.io.TFRecordWriter(path)
+    return RecordWriter(path, buffer_size)
+
 
 def old_get_blob_ratio(patch):
     """ + Document  
@@ -175,8 +517,8 @@ def get_blob_ratio(patch, thres_val=0.00):
     """ Compute Ratio of non-negative pixels in an image
         thres_val : threshold vale; defualt is 0/non-negative value
     """
-    img = copy.deepcopy(patch[:,:,0]).flatten()
-    clouds_ratio = len(np.argwhere(img > thres_val))/len(img)*100
+    img = patch[:,:,0]
+    clouds_ratio = np.count_nonzero(img > thres_val)/img.size*100
     return clouds_ratio
     
 
@@ -249,27 +591,200 @@ def interactive_writer(patches, categories, out_dir="", isHistOn=True):
     print("All patches processed. Thank you!")
 
 
-def write_patches(patches, out_dir, patches_per_record):
+def write_patches(
+    patches,
+    out_dir,
+    patches_per_record,
+    num_workers=4,
+    queue_size=64,
+    buffer_size=64 << 20,
+    precision="fp32",
+):
     """Writes `patches_per_record` patches into a tfrecord file in `out_dir`.
+    Patches are serialized by a pool of `num_workers` threads while a single writer
+    thread owns the tfrecord files, so generating, serializing and writing overlap.
     Args:
         patches: Iterable of (filename, coordinate, patch) which defines tfrecord example
             to write.
         out_dir: Directory to save tfrecords.
         patches_per_record: Number of examples to save in each tfrecord.
+        num_workers: Number of threads serializing examples.
+        queue_size: Maximum number of examples waiting to be written.
+        buffer_size: Write buffer of each tfrecord file in bytes.
+        precision: {"fp32", "bf16", "int8"} dtype of the patches on disk, see
+            `quantize_patch`.
     Side Effect:
         Examples are written to `out_dir`. File format is `out_dir`/`rank`-`k`.tfrecord
         where k means its the "k^th" record that `rank` has written.
     """
     rank = MPI.COMM_WORLD.Get_rank()
-    for i, patch in enumerate(patches):
-        if i % patches_per_record == 0:
-            rec = "{}-{}.tfrecord".format(rank, i // patches_per_record)
-            print("Writing to", rec, flush=True)
-            f = tf.python_io.TFRecordWriter(os.path.join(out_dir, rec))
+    # Futures are queued in submission order so records keep the order of `patches`
+    serialized = queue.Queue(maxsize=queue_size)
+    errors = []
+
+    def close(f, rec, n):
+        f.close()
+        print("Rank", rank, "wrote", n, "patches to", rec, flush=True)
+
+    def writer():
+        f = None
+        i = 0
+        n = 0  # records written to the current file
+        try:
+            while True:
+                future = serialized.get()
+                if future is None:
+                    return
+                if i % patches_per_record == 0:
+                    if f is not None:
+                        close(f, rec, n)
+                    rec = "{}-{}.tfrecord".format(rank, i // patches_per_record)
+                    print("Writing to", rec, flush=True)
+                    f = open_record_writer(os.path.join(out_dir, rec), buffer_size)
+                    n = 0
+
+                f.write(future.result())
+
+                n += 1
+                i += 1
+                if i % LOG_EVERY == 0:
+                    print("Rank", rank, "wrote", i, "patches", flush=True)
+        except Exception as e:
+            errors.append(e)
+            # Keep draining so the producer never blocks on a full queue
+            while serialized.get() is not None:
+                pass
+        finally:
+            if f is not None:
+                close(f, rec, n)
+
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.start()
+    with ThreadPoolExecutor(num_workers) as pool:
+        try:
+            for patch in patches:
+                if errors:
+                    break
+                serialized.put(
+                    pool.submit(serialize_example, *patch, precision=precision)
+                )
+        finally:
+            serialized.put(None)
+            writer_thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def _close_memmap_record(out_dir, rec, arr, meta):
+    path = os.path.join(out_dir, rec + ".npy")
+    n = meta["num_patches"]
+    if n < len(arr):
+        # Rewrite a partially filled record with only its written patches so loaders
+        # slicing the array never see the zero padding
+        short = np.lib.format.open_memmap(
+            path + ".tmp", mode="w+", dtype=arr.dtype, shape=(n,) + arr.shape[1:]
+        )
+        short[:] = arr[:n]
+        short.flush()
+        del short
+        os.replace(path + ".tmp", path)
+    else:
+        arr.flush()
+    with open(os.path.join(out_dir, rec + ".json"), "w") as f:
+        json.dump(meta, f)
 
-        write_feature(f, *patch)
 
-        print("Rank", rank, "wrote", i + 1, "patches", flush=True)
+def write_memmap_patches(patches, out_dir, patches_per_record, precision="fp32"):
+    """Writes `patches_per_record` patches into a .npy file in `out_dir` which training
+    can memory map with `np.load(path, mmap_mode="r")` and slice into batches without
+    parsing records.
+    Args:
+        patches: Iterable of (filename, coordinate, patch) to write.
+        out_dir: Directory to save the .npy and .json files.
+        patches_per_record: Number of patches to save in each .npy file.
+        precision: {"fp32", "bf16", "int8"} dtype of the patches on disk, see
+            `quantize_patch`.
+    Side Effect:
+        Patches are written to `out_dir`/`rank`-`k`.npy as one array of shape
+        (num_patches, height, width, channel), where num_patches is
+        `patches_per_record` except for the last, shrunk file of each rank.
+        `out_dir`/`rank`-`k`.json holds the "filename" and "coordinate" of each patch,
+        its "scale" for int8, the "dtype" of the patches and "num_patches". bfloat16
+        patches are stored as their uint16 bits.
+    """
+    rank = MPI.COMM_WORLD.Get_rank()
+    arr = None
+    for i, (filename, coord, patch) in enumerate(patches):
+        data, scale = quantize_patch(patch, precision)
+        j = i % patches_per_record
+        if j == 0:
+            if arr is not None:
+                _close_memmap_record(out_dir, rec, arr, meta)
+                n = patches_per_record
+                print("Rank", rank, "wrote", n, "patches to", rec, flush=True)
+            rec = "{}-{}".format(rank, i // patches_per_record)
+            print("Writing to", rec + ".npy", flush=True)
+            arr = np.lib.format.open_memmap(
+                os.path.join(out_dir, rec + ".npy"),
+                mode="w+",
+                dtype=data.dtype,
+                shape=(patches_per_record,) + data.shape,
+            )
+            meta = {
+                "num_patches": 0,
+                "dtype": PRECISION_DTYPES[precision],
+                "filename": [],
+                "coordinate": [],
+            }
+            if scale is not None:
+                meta["scale"] = []
+
+        arr[j] = data
+        meta["num_patches"] = j + 1
+        meta["filename"].append(filename)
+        meta["coordinate"].append([int(c) for c in coord])
+        if scale is not None:
+            meta["scale"].append(scale.tolist())
+
+        if (i + 1) % LOG_EVERY == 0:
+            print("Rank", rank, "wrote", i + 1, "patches", flush=True)
+
+    if arr is not None:
+        _close_memmap_record(out_dir, rec, arr, meta)
+        print("Rank", rank, "wrote", meta["num_patches"], "patches to", rec, flush=True)
+
+
+def serve_fnames(comm, fnames, root=0):
+    """Hands out `fnames` one at a time to whichever rank asks next with
+    `request_fnames`, so ranks with cheap files take more of them. Runs on `root`
+    until every other rank has been told there are no files left.
+    """
+    fnames = deque(fnames)
+    active = comm.Get_size() - 1
+    status = MPI.Status()
+    while active:
+        comm.recv(source=MPI.ANY_SOURCE, tag=REQUEST_TAG, status=status)
+        worker = status.Get_source()
+        if fnames:
+            comm.send(fnames.popleft(), dest=worker, tag=REPLY_TAG)
+        else:
+            comm.send(None, dest=worker, tag=REPLY_TAG)
+            active -= 1
+
+
+def request_fnames(comm, root=0):
+    """Yields filenames handed out by `serve_fnames` on `root`. The next filename is
+    requested before yielding the current one so the reply is ready by the time the
+    current file has been processed.
+    """
+    comm.send(None, dest=root, tag=REQUEST_TAG)
+    while True:
+        fname = comm.recv(source=root, tag=REPLY_TAG)
+        if fname is None:
+            return
+        comm.send(None, dest=root, tag=REQUEST_TAG)
+        yield fname
 
 
 def get_args(verbose=False):
@@ -280,10 +795,13 @@ def get_args(verbose=False):
     p.add_argument("out_dir", help="Directory to save results")
     p.add_argument(
         "mode",
-        choices=["mod09_tif", "mod02_1km"],
+        choices=["mod09_tif", "mod02_1km", "mod02_1km_h5", "mod02_1km_to_h5"],
         help="`mod09_tif`: Turn whole .tif swath into tfrecord. "
         "`mod02_1km` : Extracts EV_250_Aggr1km_RefSB, EV_500_Aggr1km_RefSB, "
-        "EV_1KM_RefSB, and EV_1KM_Emissive.",
+        "EV_1KM_RefSB, and EV_1KM_Emissive. "
+        "`mod02_1km_to_h5` : Stage those fields of each hdf file into `out_dir` as "
+        "hdf5 instead of writing tfrecords. "
+        "`mod02_1km_h5` : Same as `mod02_1km` but reads the staged hdf5 files.",
     )
     p.add_argument(
         "--shape",
@@ -307,6 +825,43 @@ def get_args(verbose=False):
     p.add_argument(
         "--patches_per_record", type=int, help="Only used for pptif", default=500
     )
+    p.add_argument(
+        "--seed",
+        type=int,
+        help="Seed of the patch shuffling. Each rank shuffles with its own stream "
+        "derived from the seed and its rank",
+        default=0,
+    )
+    p.add_argument(
+        "--format",
+        choices=["tfrecord", "memmap"],
+        help="`tfrecord`: One tf.train.Example per patch. "
+        "`memmap`: Patches stacked in .npy files with a .json sidecar of filenames "
+        "and coordinates.",
+        default="tfrecord",
+    )
+    p.add_argument(
+        "--precision",
+        choices=["fp32", "bf16", "int8"],
+        help="dtype of the patches on disk. `bf16` halves and `int8` quarters the "
+        "size of fp32 patches. `int8` stores one scale per patch channel.",
+        default="fp32",
+    )
+    p.add_argument(
+        "--num_workers",
+        type=int,
+        help="Number of threads serializing patches into tfrecord examples",
+        default=4,
+    )
+    p.add_argument(
+        "--write_buffer_mb",
+        type=int,
+        help="Write buffer of each tfrecord file in megabytes",
+        default=64,
+    )
+    p.add_argument(
+        "--verbose", action="store_true", help="Print every file as it is read"
+    )
     p.add_argument(
         "--interactive_categories",
         nargs="+",
@@ -333,21 +888,47 @@ if __name__ == "__main__":
     FLAGS = get_args(verbose=rank == 0)
     os.makedirs(FLAGS.out_dir, exist_ok=True)
 
-    fnames = []
-    for i, f in enumerate(sorted(glob.glob(FLAGS.source_glob))):
-        if i % size == rank:
-            fnames.append(os.path.abspath(f))
-
-    if not fnames:
+    source = sorted(os.path.abspath(f) for f in glob.glob(FLAGS.source_glob))
+    if not source:
         raise ValueError("source_glob does not match any files")
 
-    swaths = gen_swaths(fnames, FLAGS.mode, FLAGS.resize)
-    patches = gen_patches(swaths, FLAGS.shape, FLAGS.stride)
+    # With few ranks a dedicated rank 0 costs more than load imbalance
+    if size < 4:
+        fnames = source[rank::size]
+    elif rank == 0:
+        serve_fnames(comm, source)
+        print("Rank %d done." % rank, flush=True)
+        exit()
+    else:
+        fnames = request_fnames(comm)
 
-    if FLAGS.interactive_categories is None:
-        write_patches(patches, FLAGS.out_dir, FLAGS.patches_per_record)
+    if FLAGS.mode == "mod02_1km_to_h5":
+        for f in fnames:
+            h5_file = convert_hdf_to_h5(f, FLAGS.out_dir)
+            print("Rank", rank, "staged", h5_file, flush=True)
+        print("Rank %d done." % rank, flush=True)
+        exit()
 
-    else:
+    swaths = gen_swaths(fnames, FLAGS.mode, FLAGS.resize, FLAGS.verbose)
+    rng = np.random.default_rng(rank * 1000003 + FLAGS.seed)
+    patches = gen_patches(swaths, FLAGS.shape, FLAGS.stride, rng)
+
+    if FLAGS.interactive_categories is not None:
         interactive_writer(patches, FLAGS.interactive_categories, FLAGS.out_dir)
 
+    elif FLAGS.format == "memmap":
+        write_memmap_patches(
+            patches, FLAGS.out_dir, FLAGS.patches_per_record, FLAGS.precision
+        )
+
+    else:
+        write_patches(
+            patches,
+            FLAGS.out_dir,
+            FLAGS.patches_per_record,
+            FLAGS.num_workers,
+            buffer_size=FLAGS.write_buffer_mb << 20,
+            precision=FLAGS.precision,
+        )
+
     print("Rank %d done." % rank, flush=True)
@@ -0,0 +1,64 @@
+"""Round-trip tests of the hand-written tf.train.Example serializer in into_record.
+Run from lib_hdfs with `python -m pytest test_into_record.py` or
+`python -m unittest test_into_record`.
+"""
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from into_record import PRECISION_DTYPES, quantize_patch, serialize_example
+
+
+class SerializeExampleTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.patch = rng.standard_normal((16, 12, 6)).astype(np.float32)
+
+    def check_roundtrip(self, filename, coord, patch, precision):
+        out = serialize_example(filename, coord, patch, precision)
+        feature = tf.train.Example.FromString(out).features.feature
+
+        expected_keys = {"filename", "coordinate", "shape", "patch", "dtype"}
+        if precision == "int8":
+            expected_keys.add("scale")
+        self.assertEqual(set(feature.keys()), expected_keys)
+
+        data, scale = quantize_patch(patch, precision)
+        self.assertEqual(
+            list(feature["filename"].bytes_list.value), [filename.encode("utf-8")]
+        )
+        self.assertEqual(list(feature["coordinate"].int64_list.value), list(coord))
+        self.assertEqual(list(feature["shape"].int64_list.value), list(patch.shape))
+        self.assertEqual(list(feature["patch"].bytes_list.value), [data.tobytes()])
+        self.assertEqual(
+            list(feature["dtype"].bytes_list.value),
+            [PRECISION_DTYPES[precision].encode("utf-8")],
+        )
+        if scale is not None:
+            np.testing.assert_array_equal(
+                np.array(feature["scale"].float_list.value, dtype=np.float32), scale
+            )
+
+    def test_precisions(self):
+        for precision in ("fp32", "bf16", "int8"):
+            with self.subTest(precision=precision):
+                self.check_roundtrip(
+                    "/data/MOD021KM.A2015179.hdf", (448, 320), self.patch, precision
+                )
+
+    def test_negative_coordinate(self):
+        for precision in ("fp32", "bf16", "int8"):
+            with self.subTest(precision=precision):
+                self.check_roundtrip("swath.tif", (-3, 70), self.patch, precision)
+
+    def test_non_contiguous_patch(self):
+        patch = self.patch[::-1].transpose(1, 0, 2)
+        self.assertFalse(patch.flags.c_contiguous)
+        for precision in ("fp32", "bf16", "int8"):
+            with self.subTest(precision=precision):
+                self.check_roundtrip("swath.tif", (0, 64), patch, precision)
+
+
+if __name__ == "__main__":
+    unittest.main()